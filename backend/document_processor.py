@@ -1,27 +1,92 @@
+import io
+import multiprocessing
+import os
+import re
 import PyPDF2
 import docx
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import repeat
 from typing import List
 from langchain.text_splitter import RecursiveCharacterTextSplitter
+from semantic_text_splitter import TextSplitter
+
+# PDFs with fewer pages are extracted inline; below this, shipping the file to workers costs more than it saves
+PDF_PARALLEL_MIN_PAGES = int(os.getenv("PDF_PARALLEL_MIN_PAGES", 16))
+PDF_WORKERS = int(os.getenv("PDF_WORKERS", os.cpu_count() or 1))
+
+# "rust" uses semantic-text-splitter; "langchain" keeps the original RecursiveCharacterTextSplitter
+TEXT_SPLITTER = os.getenv("TEXT_SPLITTER", "rust").lower()
+
+# Separators the LangChain splitter tries in order
+SEPARATORS = ("\n\n", "\n", ". ", " ", "")
+
+# Shortest shared edge treated as real chunk overlap when merging neighbours
+MIN_OVERLAP_MATCH = 10
+
+# Whitespace runs collapsed by preprocess_text
+_WS_RE = re.compile(r"\s+")
+
+
+def _extract_page_range(pdf_bytes: bytes, start: int, stop: int) -> List[str]:
+    """Extract text from pages [start, stop) using a reader private to this worker"""
+    reader = PyPDF2.PdfReader(io.BytesIO(pdf_bytes))
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+
+@lru_cache(maxsize=8)
+def _make_splitter(chunk_size: int, chunk_overlap: int):
+    """Build the configured character splitter once per (size, overlap) pair"""
+    if TEXT_SPLITTER == "langchain":
+        return RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            separators=list(SEPARATORS)
+        )
+    # Rust splitter: same paragraph > line > sentence > word fallback, without Python loops
+    return TextSplitter(chunk_size, overlap=chunk_overlap)
 
 
 class DocumentProcessor:
     def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200):
         self.chunk_size = chunk_size
         self.chunk_overlap = chunk_overlap
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-            separators=["\n\n", "\n", ". ", " ", ""]  # Try these separators in order
-        )
+        self.pdf_pool = None
+
+    def start_pdf_pool(self):
+        """Start the process pool that extracts large PDFs, shared for the life of the app"""
+        if PDF_WORKERS < 2 or self.pdf_pool is not None:
+            return
+        # Forking this multithreaded process (torch, ONNX Runtime, thread pools) can deadlock the child,
+        # so workers come from a clean forkserver, or spawn where that is unavailable
+        method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.pdf_pool = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context(method))
+
+    def shutdown(self):
+        """Stop the PDF extraction pool"""
+        if self.pdf_pool is not None:
+            self.pdf_pool.shutdown(wait=False, cancel_futures=True)
+            self.pdf_pool = None
 
     def process_pdf(self, file_content) -> str:
         """Extract text from PDF file"""
         try:
             pdf_reader = PyPDF2.PdfReader(file_content)
-            text = ""
-            for page in pdf_reader.pages:
-                text += page.extract_text() + "\n"
-            return text.strip()
+            page_count = len(pdf_reader.pages)
+
+            if self.pdf_pool is None or page_count < PDF_PARALLEL_MIN_PAGES:
+                texts = [page.extract_text() or "" for page in pdf_reader.pages]
+            else:
+                # PyPDF2 is pure Python and its reader is not thread-safe, so split
+                # contiguous page ranges across processes that each parse their own copy
+                file_content.seek(0)
+                pdf_bytes = file_content.read()
+                workers = min(PDF_WORKERS, page_count)
+                bounds = [page_count * i // workers for i in range(workers + 1)]
+                ranges = self.pdf_pool.map(_extract_page_range, repeat(pdf_bytes), bounds[:-1], bounds[1:])
+                texts = [text for page_texts in ranges for text in page_texts]
+
+            return "\n".join(texts).strip()
         except Exception as e:
             raise Exception(f"Error processing PDF: {str(e)}")
 
@@ -45,20 +110,47 @@ class DocumentProcessor:
         except Exception as e:
             raise Exception(f"Error processing TXT: {str(e)}")
 
-    def chunk_text(self, text: str) -> List[str]:
-        """Split text into chunks using LlamaIndex RecursiveCharacterTextSplitter"""
+    def _split(self, text: str, size: int, overlap: int) -> List[str]:
+        """Run the cached character splitter for this size and overlap"""
+        splitter = _make_splitter(size, overlap)
+        if TEXT_SPLITTER == "langchain":
+            return splitter.split_text(text)
+        return splitter.chunks(text)
+
+    def _join_chunks(self, left: str, right: str, overlap: int) -> str:
+        """Concatenate neighbouring chunks, dropping the text they share through overlap"""
+        for size in range(min(len(left), len(right), overlap), MIN_OVERLAP_MATCH - 1, -1):
+            if left.endswith(right[:size]):
+                return left + right[size:]
+        return left + "\n" + right
+
+    def _merge_tiny(self, chunks: List[str], overlap: int, max_size: int, min_size: int = 100) -> List[str]:
+        """Greedily merge undersized chunks into their neighbours without exceeding max_size"""
+        merged = []
+        for chunk in chunks:
+            if merged and (len(merged[-1]) < min_size or len(chunk) < min_size):
+                combined = self._join_chunks(merged[-1], chunk, overlap)
+                if len(combined) <= max_size:
+                    merged[-1] = combined
+                    continue
+            merged.append(chunk)
+        return merged
+
+    def chunk_text(self, text: str, size: int = None, overlap: int = None) -> List[str]:
+        """Split text into chunks, then regularize their sizes"""
+        size = size or self.chunk_size
+        overlap = self.chunk_overlap if overlap is None else overlap
+        # The splitter never exceeds size and merging is capped here, so no chunk needs splitting again
+        max_size = int(size * 1.15)
         try:
-            chunks = self.text_splitter.split_text(text)
-            return [chunk for chunk in chunks if len(chunk.strip()) > 50]  # Filter out very short chunks
+            chunks = self._merge_tiny(self._split(text, size, overlap), overlap, max_size)
+            # Normalize whitespace so identical passages produce identical embedding cache keys
+            chunks = [self.preprocess_text(chunk) for chunk in chunks]
+            return [chunk for chunk in chunks if len(chunk) > 50]  # Filter out leftovers too short to merge
         except Exception as e:
             raise Exception(f"Error chunking text: {str(e)}")
 
     def preprocess_text(self, text: str) -> str:
         """Clean and preprocess text"""
-        # Remove excessive whitespace
-        text = ' '.join(text.split())
-
-        # Remove special characters that might interfere with processing
-        text = text.replace('\x00', '')  # Remove null characters
-
-        return text.strip()
\ No newline at end of file
+        # Remove null characters, then collapse whitespace in one pass without building a token list
+        return _WS_RE.sub(" ", text.translate({0: None})).strip()
\ No newline at end of file
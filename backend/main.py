@@ -1,15 +1,24 @@
-from fastapi import FastAPI, UploadFile, File, Depends, HTTPException
+from fastapi import FastAPI, UploadFile, File, Depends, HTTPException, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from sqlalchemy import delete, select, update
 from sqlalchemy.orm import Session
 from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
 import uuid
 from datetime import datetime
-import io
 import os
+import tempfile
+import threading
 from pydantic import BaseModel
 
 # Import our database models and functions
-from database import get_db, Chat, ChatMessage, Document, DocumentChunk, create_tables
+from database import (
+    get_db, SessionLocal, Chat, ChatMessage, Document, UploadJob,
+    create_tables, rebuild_vector_index, bulk_insert_chunks
+)
 
 # Import document processing and RAG components
 from document_processor import DocumentProcessor
@@ -26,6 +35,25 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Uploads are streamed into buffers that stay in memory up to this size, then spill to disk
+UPLOAD_SPOOL_MAX_SIZE = 8 << 20
+UPLOAD_READ_SIZE = 1 << 20
+
+# Supported upload extensions
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.txt')
+
+# Shared pool for blocking CPU work (parsing, chunking) so it never runs on the event loop
+EXECUTOR = ThreadPoolExecutor(max_workers=max(4, os.cpu_count() or 1))
+
+# Number of chunks retrieved per query
+SIMILARITY_TOP_K = int(os.getenv("SIMILARITY_TOP_K", 5))
+
+# Answer given when a chat has no documents to search
+NO_DOCUMENTS_RESPONSE = (
+    "I don't have any documents uploaded for this chat yet. "
+    "Please upload some documents first to ask questions about them."
+)
+
 # Initialize systems
 doc_processor = DocumentProcessor()
 rag_system = RAGSystem()
@@ -56,110 +84,251 @@ class MessageResponse(BaseModel):
     timestamp: datetime
 
 
+class UploadJobResponse(BaseModel):
+    job_id: str
+    chat_id: str
+    filename: str
+    status: str
+    document_id: Optional[str] = None
+    chunks_count: Optional[int] = None
+    error: Optional[str] = None
+
+
 class QueryRequest(BaseModel):
     query: str
-    chat_id: str  # Make chat_id required
+    chat_id: uuid.UUID  # Make chat_id required
 
 
 @app.on_event("startup")
 async def startup_event():
     """Initialize database tables on startup"""
-    create_tables()
+    await run_in_threadpool(create_tables)
+    await run_in_threadpool(fail_interrupted_uploads)
+    doc_processor.start_pdf_pool()
     await rag_system.initialize()
 
+    # A tier rebuild of a large index can take a long time, so it runs after startup instead of delaying it;
+    # the daemon thread is abandoned on exit and the half-built index is dropped at the next startup
+    threading.Thread(target=rebuild_vector_index, name="vector-index-rebuild", daemon=True).start()
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Release the document processing pools and stop background RAG tasks"""
+    EXECUTOR.shutdown(wait=False)
+    doc_processor.shutdown()
+    await rag_system.shutdown()
+
+
+def extract_text(filename: str, buffer) -> str:
+    """Extract text from an uploaded file based on its extension"""
+    if filename.endswith('.pdf'):
+        return doc_processor.process_pdf(buffer)
+    if filename.endswith('.docx'):
+        return doc_processor.process_docx(buffer)
+    return doc_processor.process_txt(buffer.read())
+
+
+def store_document(
+        job_id: uuid.UUID, chat_id: uuid.UUID, filename: str, text_content: str,
+        chunks: List[str], embeddings: List[List[float]]
+):
+    """Persist a processed document and its chunks, and mark its upload job completed"""
+    db = SessionLocal()
+    try:
+        # Save document to database with chat_id
+        doc = Document(
+            chat_id=chat_id,
+            filename=filename,
+            content=text_content
+        )
+        db.add(doc)
+        db.flush()
+
+        bulk_insert_chunks(db, [
+            {
+                "chat_id": chat_id,
+                "document_id": doc.id,
+                "chunk_text": chunk,
+                "chunk_index": i,
+                "embedding": embedding
+            }
+            for i, (chunk, embedding) in enumerate(zip(chunks, embeddings))
+        ])
+
+        db.execute(
+            update(UploadJob)
+            .where(UploadJob.id == job_id)
+            .values(status="completed", document_id=doc.id, chunks_count=len(chunks))
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+def mark_upload_failed(job_id: uuid.UUID, error: str):
+    """Record why an upload job failed"""
+    db = SessionLocal()
+    try:
+        db.execute(update(UploadJob).where(UploadJob.id == job_id).values(status="failed", error=error))
+        db.commit()
+    finally:
+        db.close()
+
+
+def fail_interrupted_uploads():
+    """Fail upload jobs left processing by a previous process, whose background tasks died with it"""
+    db = SessionLocal()
+    try:
+        result = db.execute(
+            update(UploadJob)
+            .where(UploadJob.status == "processing")
+            .values(status="failed", error="Upload interrupted by a server restart, please upload the file again")
+        )
+        db.commit()
+        if result.rowcount:
+            print(f"Marked {result.rowcount} interrupted upload jobs as failed")
+    finally:
+        db.close()
+
+
+async def process_upload(job_id: uuid.UUID, chat_id: uuid.UUID, filename: str, buffer):
+    """Parse, chunk, embed, and store one uploaded document, recording the outcome on its job"""
+    loop = asyncio.get_running_loop()
+    try:
+        with buffer:
+            text_content = await loop.run_in_executor(EXECUTOR, extract_text, filename, buffer)
+
+        # Embed all chunks in one batch; parsing, chunking and storing all run off the event loop
+        chunks = await loop.run_in_executor(EXECUTOR, doc_processor.chunk_text, text_content)
+        embeddings = await rag_system.get_embeddings(chunks)
+        await run_in_threadpool(store_document, job_id, chat_id, filename, text_content, chunks, embeddings)
+
+    except Exception as e:
+        print(f"Error processing {filename}: {str(e)}")
+        await run_in_threadpool(mark_upload_failed, job_id, f"Error processing {filename}: {str(e)}")
+
+
+def chat_exists(db: Session, chat_id: uuid.UUID) -> bool:
+    """Check whether a chat exists without loading its row"""
+    return db.query(db.query(Chat.id).filter(Chat.id == chat_id).exists()).scalar()
+
+
+def taken_filenames(db: Session, chat_id: uuid.UUID) -> set:
+    """Filenames already stored or still being processed in a chat"""
+    filenames = set(
+        db.execute(select(Document.filename).where(Document.chat_id == chat_id)).scalars()
+    )
+    filenames.update(
+        db.execute(
+            select(UploadJob.filename).where(UploadJob.chat_id == chat_id, UploadJob.status == "processing")
+        ).scalars()
+    )
+    return filenames
+
+
+def save_chat_message(db: Session, chat_id: uuid.UUID, query: str, response: str):
+    """Save a question and answer to chat history and bump the chat's updated_at"""
+    db.add(ChatMessage(
+        chat_id=chat_id,
+        message=query,
+        response=response
+    ))
+    db.execute(update(Chat).where(Chat.id == chat_id).values(updated_at=datetime.utcnow()))
+    db.commit()
+
 
-@app.post("/upload-documents/{chat_id}")
+def save_streamed_message(chat_id: uuid.UUID, query: str, response: str):
+    """Save a generated answer on its own short-lived session, so no connection is held during generation"""
+    db = SessionLocal()
+    try:
+        save_chat_message(db, chat_id, query, response)
+    finally:
+        db.close()
+
+
+@app.post("/upload-documents/{chat_id}", status_code=202)
 async def upload_documents(
-        chat_id: str,
+        chat_id: uuid.UUID,
+        background_tasks: BackgroundTasks,
         files: List[UploadFile] = File(...),
         db: Session = Depends(get_db)
 ):
-    """Upload and process multiple documents for a specific chat"""
-
-    # Verify chat exists
-    chat = db.query(Chat).filter(Chat.id == uuid.UUID(chat_id)).first()
-    if not chat:
+    """Accept documents for a specific chat and process them in the background"""
+    # Verify chat exists; database calls run in the threadpool so they never block the event loop
+    if not await run_in_threadpool(chat_exists, db, chat_id):
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    # Check for existing documents with same filenames in this chat
-    existing_filenames = db.query(Document.filename).filter(
-        Document.chat_id == uuid.UUID(chat_id)
-    ).all()
-    existing_filenames = [filename[0] for filename in existing_filenames]
+    # Files already stored or still being processed in this chat count as duplicates
+    existing_filenames = await run_in_threadpool(taken_filenames, db, chat_id)
 
-    uploaded_docs = []
+    pending = []
+    queued_docs = []
     skipped_docs = []
 
     for file in files:
-        try:
-            # Check if file already exists in this chat
-            if file.filename in existing_filenames:
-                skipped_docs.append({
-                    "filename": file.filename,
-                    "reason": "File already exists in this chat"
-                })
-                continue
-
-            # Read file content
-            content = await file.read()
-
-            # Process document based on file type
-            if file.filename.endswith('.pdf'):
-                text_content = doc_processor.process_pdf(io.BytesIO(content))
-            elif file.filename.endswith('.docx'):
-                text_content = doc_processor.process_docx(io.BytesIO(content))
-            elif file.filename.endswith('.txt'):
-                text_content = content.decode('utf-8')
-            else:
-                skipped_docs.append({
-                    "filename": file.filename,
-                    "reason": f"Unsupported file type"
-                })
-                continue
-
-            # Save document to database with chat_id
-            doc = Document(
-                chat_id=uuid.UUID(chat_id),
-                filename=file.filename,
-                content=text_content
-            )
-            db.add(doc)
-            db.commit()
-            db.refresh(doc)
-
-            # Process and store chunks with embeddings
-            chunks = doc_processor.chunk_text(text_content)
-            for i, chunk in enumerate(chunks):
-                embedding = await rag_system.get_embedding(chunk)
-
-                doc_chunk = DocumentChunk(
-                    chat_id=uuid.UUID(chat_id),
-                    document_id=doc.id,
-                    chunk_text=chunk,
-                    chunk_index=i,
-                    embedding=embedding
-                )
-                db.add(doc_chunk)
-
-            db.commit()
-            uploaded_docs.append({
-                "id": str(doc.id),
+        # Check if file already exists in this chat
+        if file.filename in existing_filenames:
+            skipped_docs.append({
                 "filename": file.filename,
-                "chunks_count": len(chunks)
+                "reason": "File already exists in this chat"
             })
+            continue
 
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error processing {file.filename}: {str(e)}")
+        if not file.filename.endswith(SUPPORTED_EXTENSIONS):
+            skipped_docs.append({
+                "filename": file.filename,
+                "reason": f"Unsupported file type"
+            })
+            continue
+
+        # Stream file content into a spooled buffer that outlives the request
+        buffer = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_MAX_SIZE)
+        while block := await file.read(UPLOAD_READ_SIZE):
+            buffer.write(block)
+        buffer.seek(0)
+
+        job = UploadJob(id=uuid.uuid4(), chat_id=chat_id, filename=file.filename)
+        db.add(job)
+        existing_filenames.add(file.filename)
+        pending.append((job.id, file.filename, buffer))
+        queued_docs.append({"job_id": str(job.id), "filename": file.filename})
+
+    await run_in_threadpool(db.commit)
+
+    # Processing starts once the response has been sent
+    for job_id, filename, buffer in pending:
+        background_tasks.add_task(process_upload, job_id, chat_id, filename, buffer)
 
     return {
-        "message": f"Successfully uploaded {len(uploaded_docs)} documents",
-        "uploaded": uploaded_docs,
+        "message": f"Queued {len(queued_docs)} documents for processing",
+        "status": "processing",
+        "job_ids": [doc["job_id"] for doc in queued_docs],
+        "queued": queued_docs,
         "skipped": skipped_docs
     }
 
 
+@app.get("/uploads/{job_id}", response_model=UploadJobResponse)
+def get_upload_status(job_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Get the processing status of an uploaded document"""
+    job = db.get(UploadJob, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Upload job not found")
+
+    return UploadJobResponse(
+        job_id=str(job.id),
+        chat_id=str(job.chat_id),
+        filename=job.filename,
+        status=job.status,
+        document_id=str(job.document_id) if job.document_id else None,
+        chunks_count=job.chunks_count,
+        error=job.error
+    )
+
+
 @app.post("/chats", response_model=ChatResponse)
-async def create_chat(chat: ChatCreate, db: Session = Depends(get_db)):
+def create_chat(chat: ChatCreate, db: Session = Depends(get_db)):
     """Create a new chat"""
     new_chat = Chat(title=chat.title)
     db.add(new_chat)
@@ -175,7 +344,7 @@ async def create_chat(chat: ChatCreate, db: Session = Depends(get_db)):
 
 
 @app.get("/chats", response_model=List[ChatResponse])
-async def get_chats(db: Session = Depends(get_db)):
+def get_chats(db: Session = Depends(get_db)):
     """Get all chats"""
     chats = db.query(Chat).order_by(Chat.updated_at.desc()).all()
     return [
@@ -190,10 +359,10 @@ async def get_chats(db: Session = Depends(get_db)):
 
 
 @app.get("/chats/{chat_id}/messages", response_model=List[MessageResponse])
-async def get_chat_messages(chat_id: str, db: Session = Depends(get_db)):
+def get_chat_messages(chat_id: uuid.UUID, db: Session = Depends(get_db)):
     """Get messages for a specific chat"""
     messages = db.query(ChatMessage).filter(
-        ChatMessage.chat_id == uuid.UUID(chat_id)
+        ChatMessage.chat_id == chat_id
     ).order_by(ChatMessage.timestamp).all()
 
     return [
@@ -212,16 +381,18 @@ async def get_chat_messages(chat_id: str, db: Session = Depends(get_db)):
 async def query_documents(request: QueryRequest, db: Session = Depends(get_db)):
     """Query documents using RAG system"""
     try:
-        if not request.chat_id:
-            raise HTTPException(status_code=400, detail="chat_id is required")
-
-        # Get relevant chunks using vector similarity for the specific chat
-        relevant_chunks = await rag_system.get_relevant_chunks(request.query, request.chat_id, db)
+        # Get relevant chunks for the specific chat
+        relevant_chunks = await rag_system.get_relevant_chunks(
+            request.query, request.chat_id, db, top_k=SIMILARITY_TOP_K
+        )
+        # End the read-only retrieval transaction so the connection isn't held idle in transaction
+        # for the whole generation
+        await run_in_threadpool(db.rollback)
 
         if not relevant_chunks:
             return {
                 "query": request.query,
-                "response": "I don't have any documents uploaded for this chat yet. Please upload some documents first to ask questions about them.",
+                "response": NO_DOCUMENTS_RESPONSE,
                 "sources": 0
             }
 
@@ -229,19 +400,7 @@ async def query_documents(request: QueryRequest, db: Session = Depends(get_db)):
         response = await rag_system.generate_response(request.query, relevant_chunks)
 
         # Save to chat history
-        chat_message = ChatMessage(
-            chat_id=uuid.UUID(request.chat_id),
-            message=request.query,
-            response=response
-        )
-        db.add(chat_message)
-
-        # Update chat's updated_at timestamp
-        chat = db.query(Chat).filter(Chat.id == uuid.UUID(request.chat_id)).first()
-        if chat:
-            chat.updated_at = datetime.utcnow()
-
-        db.commit()
+        await run_in_threadpool(save_streamed_message, request.chat_id, request.query, response)
 
         return {
             "query": request.query,
@@ -253,11 +412,41 @@ async def query_documents(request: QueryRequest, db: Session = Depends(get_db)):
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
 
+@app.post("/query/stream")
+async def query_documents_stream(request: QueryRequest, db: Session = Depends(get_db)):
+    """Query documents using RAG system, streaming the response as plain text while it is generated"""
+    try:
+        # Get relevant chunks for the specific chat
+        relevant_chunks = await rag_system.get_relevant_chunks(
+            request.query, request.chat_id, db, top_k=SIMILARITY_TOP_K
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
+    finally:
+        # The request session is only torn down after the body finishes streaming; end its read-only
+        # transaction now so the connection isn't held idle in transaction for the whole generation
+        await run_in_threadpool(db.rollback)
+
+    if not relevant_chunks:
+        return StreamingResponse(iter([NO_DOCUMENTS_RESPONSE]), media_type="text/plain; charset=utf-8")
+
+    async def stream():
+        parts = []
+        async for token in rag_system.stream_response(request.query, relevant_chunks):
+            parts.append(token)
+            yield token
+
+        # Save to chat history once the full response is known
+        await run_in_threadpool(save_streamed_message, request.chat_id, request.query, "".join(parts))
+
+    return StreamingResponse(stream(), media_type="text/plain; charset=utf-8")
+
+
 @app.get("/chats/{chat_id}/documents")
-async def get_chat_documents(chat_id: str, db: Session = Depends(get_db)):
+def get_chat_documents(chat_id: uuid.UUID, db: Session = Depends(get_db)):
     """Get all documents for a specific chat"""
     documents = db.query(Document).filter(
-        Document.chat_id == uuid.UUID(chat_id)
+        Document.chat_id == chat_id
     ).order_by(Document.upload_date.desc()).all()
 
     return [
@@ -271,35 +460,17 @@ async def get_chat_documents(chat_id: str, db: Session = Depends(get_db)):
 
 
 @app.delete("/documents/{document_id}")
-async def delete_document(document_id: str, db: Session = Depends(get_db)):
-    """Delete a document and its chunks"""
-    # Delete chunks first
-    db.query(DocumentChunk).filter(DocumentChunk.document_id == uuid.UUID(document_id)).delete()
-
-    # Delete document
-    db.query(Document).filter(Document.id == uuid.UUID(document_id)).delete()
-
+def delete_document(document_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Delete a document; its chunks are removed by ON DELETE CASCADE"""
+    db.execute(delete(Document).where(Document.id == document_id))
     db.commit()
     return {"message": "Document deleted successfully"}
 
 
 @app.delete("/chats/{chat_id}")
-async def delete_chat(chat_id: str, db: Session = Depends(get_db)):
-    """Delete a chat, its messages, documents, and chunks"""
-    chat_uuid = uuid.UUID(chat_id)
-
-    # Delete document chunks first
-    db.query(DocumentChunk).filter(DocumentChunk.chat_id == chat_uuid).delete()
-
-    # Delete documents
-    db.query(Document).filter(Document.chat_id == chat_uuid).delete()
-
-    # Delete messages
-    db.query(ChatMessage).filter(ChatMessage.chat_id == chat_uuid).delete()
-
-    # Delete chat
-    db.query(Chat).filter(Chat.id == chat_uuid).delete()
-
+def delete_chat(chat_id: uuid.UUID, db: Session = Depends(get_db)):
+    """Delete a chat; its messages, documents, and chunks are removed by ON DELETE CASCADE"""
+    db.execute(delete(Chat).where(Chat.id == chat_id))
     db.commit()
     return {"message": "Chat and all associated data deleted successfully"}
 
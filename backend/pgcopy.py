@@ -0,0 +1,42 @@
+"""Encode document chunks in PostgreSQL's binary COPY format"""
+import struct
+import uuid
+from typing import Any, Dict, Iterable, List
+
+# Signature, flags and header extension length that open every binary COPY stream
+PGCOPY_HEADER = b"PGCOPY\n\xff\r\n\x00" + struct.pack(">ii", 0, 0)
+
+# A field count of -1 ends the stream
+PGCOPY_TRAILER = struct.pack(">h", -1)
+
+# Columns of document_chunks in the order encode_chunk_rows writes them
+CHUNK_COPY_COLUMNS = ("id", "chat_id", "document_id", "chunk_text", "chunk_index", "embedding")
+
+
+def encode_halfvec(values: Iterable[float]) -> bytes:
+    """Encode a vector as pgvector's halfvec binary value: dimensions, an unused int16, then float16s"""
+    values = [float(value) for value in values]
+    return struct.pack(f">HH{len(values)}e", len(values), 0, *values)
+
+
+def encode_chunk_rows(rows: List[Dict[str, Any]]) -> bytes:
+    """Encode chunk rows as a binary COPY stream over CHUNK_COPY_COLUMNS, generating ids that are missing"""
+    parts = [PGCOPY_HEADER]
+    for row in rows:
+        chunk_id = row.get("id") or uuid.uuid4()
+        chunk_text = row["chunk_text"].encode()
+        embedding = encode_halfvec(row["embedding"])
+        # Each row is a field count followed by length-prefixed fields
+        parts.append(struct.pack(
+            ">hi16si16si16si",
+            len(CHUNK_COPY_COLUMNS),
+            16, chunk_id.bytes,
+            16, row["chat_id"].bytes,
+            16, row["document_id"].bytes,
+            len(chunk_text)
+        ))
+        parts.append(chunk_text)
+        parts.append(struct.pack(">iii", 4, row["chunk_index"], len(embedding)))
+        parts.append(embedding)
+    parts.append(PGCOPY_TRAILER)
+    return b"".join(parts)
@@ -176,37 +176,150 @@
 #             return "New Chat"
 
 import ollama
+import os
+import diskcache
+import hashlib
+import httpx
 import numpy as np
-from typing import List, Dict, Any
+import torch
+import xxhash
+from collections import OrderedDict
+from string import Template
+from typing import AsyncIterator, List, Dict, Any
 from sqlalchemy.orm import Session
 from sqlalchemy import text
-from sentence_transformers import SentenceTransformer
-from database import DocumentChunk
+from sentence_transformers import SentenceTransformer, export_dynamic_quantized_onnx_model
+from database import EMBEDDING_DIMENSION, BINARY_RERANK_FACTOR, apply_hnsw_search_params
 import uuid
 import asyncio
 
+# On-disk LRU cache of chunk embeddings, shared across uploads and restarts
+EMBEDDING_CACHE_DIR = os.path.expanduser(os.getenv("EMBEDDING_CACHE_DIR", "~/.cache/rag/embeddings"))
+EMBEDDING_CACHE_SIZE_LIMIT = int(os.getenv("EMBEDDING_CACHE_SIZE_LIMIT", 1 << 30))
+
+# CPU inference uses a dynamically quantized INT8 ONNX export cached here; empty ONNX_QUANTIZATION disables it
+ONNX_CACHE_DIR = os.path.expanduser(os.getenv("ONNX_CACHE_DIR", "~/.cache/rag/onnx-int8"))
+ONNX_QUANTIZATION = os.getenv("ONNX_QUANTIZATION", "avx512_vnni")
+
+# CPU embedding threads, applied to both PyTorch and the ONNX Runtime session: intra-op threads for the
+# encoder math, a couple of inter-op threads for scheduling
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS") or max(1, (os.cpu_count() or 2) // 2))
+TORCH_INTEROP_THREADS = int(os.getenv("TORCH_INTEROP_THREADS", 2))
+
+# Concurrent query embeddings are coalesced into batches of up to this size, waiting at most this long
+EMBEDDING_MAX_BATCH = int(os.getenv("EMBEDDING_MAX_BATCH", 32))
+EMBEDDING_MAX_WAIT = float(os.getenv("EMBEDDING_MAX_WAIT_MS", 5)) / 1000
+
+# In-memory LRU of recent query embeddings, so retried and repeated questions skip the model
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 1024))
+
+# Ollama server; generations can run for minutes but an unreachable server should fail fast
+OLLAMA_HOST = os.getenv("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_TIMEOUT = float(os.getenv("OLLAMA_TIMEOUT", 300))
+OLLAMA_CONNECT_TIMEOUT = float(os.getenv("OLLAMA_CONNECT_TIMEOUT", 10))
+
+# How long Ollama keeps the model loaded after a request, so chats don't pay for reloading it
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "30m")
+
+# Identical system message on every request, so Ollama can reuse its cached prefix
+STATIC_INSTRUCTIONS = (
+    "Based on the provided context, please answer the question. "
+    "If the answer cannot be found in the context, please say so."
+)
+
+# Per-query part of the answer prompt, parsed once and filled per query
+ANSWER_PROMPT = Template("""Context:
+$context
+
+Question: $query""")
+
+# Sampling options for answers, shared by the blocking and streaming paths
+RESPONSE_OPTIONS = {
+    'temperature': 0.7,
+    'top_p': 0.9,
+    'max_tokens': 1000
+}
+
+# Chunk search for one chat, built once at import: pull coarse candidates from the binary HNSW index
+# by Hamming distance, re-rank them by exact negative inner product on halfvec, and let Postgres
+# assemble the rows into one JSON array
+SIMILARITY_QUERY = text(f"""
+    WITH candidates AS (
+        SELECT id
+        FROM document_chunks
+        WHERE chat_id = :chat_id
+        ORDER BY embedding_bin <~> binary_quantize(CAST(:query_embedding AS halfvec({EMBEDDING_DIMENSION})))
+        LIMIT :candidates
+    )
+    SELECT jsonb_agg(t ORDER BY t.similarity_score DESC)
+    FROM (
+        SELECT 
+            dc.chunk_text AS text,
+            dc.chunk_index,
+            d.filename,
+            -- Inner product of unit vectors is cosine similarity
+            -(dc.embedding <#> CAST(:query_embedding AS halfvec({EMBEDDING_DIMENSION}))) AS similarity_score
+        FROM candidates c
+        JOIN document_chunks dc ON dc.id = c.id
+        JOIN documents d ON dc.document_id = d.id
+        ORDER BY dc.embedding <#> CAST(:query_embedding AS halfvec({EMBEDDING_DIMENSION}))
+        LIMIT :limit
+    ) t
+""")
+
+# Unscored chunks for one chat, used when the similarity search fails
+FALLBACK_QUERY = text("""
+    SELECT dc.chunk_text, dc.chunk_index, d.filename
+    FROM document_chunks dc
+    JOIN documents d ON dc.document_id = d.id
+    WHERE dc.chat_id = :chat_id
+    LIMIT :limit
+""")
+
 
 class RAGSystem:
     def __init__(self, model_name: str = "llama3", embedding_model: str = "all-MiniLM-L6-v2"):
         self.model_name = model_name
         self.embedding_model_name = embedding_model
         self.embedding_model = None
-        self.client = ollama.Client()
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.embedding_batch_size = 128 if self.device == "cuda" else 64
+        self.autocast_bf16 = False
+        self.embedding_cache = diskcache.Cache(
+            EMBEDDING_CACHE_DIR,
+            size_limit=EMBEDDING_CACHE_SIZE_LIMIT,
+            eviction_policy="least-recently-used"
+        )
+        self._embedding_queue = None
+        self._batch_task = None
+        self._query_embedding_cache: OrderedDict[bytes, List[float]] = OrderedDict()
+        # One pooled keep-alive client shared by every request, awaited so generations don't block the loop
+        self.client = ollama.AsyncClient(
+            host=OLLAMA_HOST,
+            timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT)
+        )
 
     async def initialize(self):
         """Initialize the RAG system"""
         try:
             # Initialize embedding model
-            self.embedding_model = SentenceTransformer(self.embedding_model_name)
+            if self.device == "cpu":
+                self._configure_cpu_threads()
+            self.embedding_model = self._load_embedding_model()
+            print(f"Embedding model loaded on {self.device}")
+
+            # Start the micro-batcher that serves get_embedding
+            self._embedding_queue = asyncio.Queue()
+            self._batch_task = asyncio.create_task(self._batch_loop())
 
             # Check if Ollama model is available
-            models = self.client.list()
+            models = await self.client.list()
             model_names = [model['model'] for model in models['models']]
 
             if self.model_name not in model_names:
                 print(f"Model {self.model_name} not found. Available models: {model_names}")
                 print(f"Pulling {self.model_name} model...")
-                self.client.pull(self.model_name)
+                await self.client.pull(self.model_name)
                 print(f"Successfully pulled {self.model_name}")
 
             print("RAG System initialized successfully")
@@ -215,110 +328,232 @@ class RAGSystem:
             print(f"Error initializing RAG system: {str(e)}")
             raise
 
-    async def get_embedding(self, text: str) -> List[float]:
-        """Generate embedding for text using SentenceTransformer"""
+    def _load_embedding_model(self) -> SentenceTransformer:
+        """Load the embedding model: FP16 on GPU, INT8 ONNX on CPU, FP32 PyTorch as the fallback"""
+        if self.device == "cuda":
+            model = SentenceTransformer(self.embedding_model_name, device=self.device)
+            model.half()
+            return model
+
+        if ONNX_QUANTIZATION:
+            try:
+                return self._load_quantized_onnx_model()
+            except Exception as e:
+                print(f"INT8 ONNX embedding model unavailable, falling back to PyTorch: {str(e)}")
+
+        # BF16 autocast only pays off with AMX tiles; elsewhere it is slower than FP32
+        self.autocast_bf16 = getattr(torch.cpu, "_is_amx_tile_supported", lambda: False)()
+        return SentenceTransformer(self.embedding_model_name, device=self.device)
+
+    def _configure_cpu_threads(self):
+        """Pin PyTorch CPU thread pools so concurrent encodes don't oversubscribe cores"""
+        torch.set_num_threads(TORCH_NUM_THREADS)
         try:
-            # Run embedding generation in thread pool to avoid blocking
-            loop = asyncio.get_event_loop()
-            embedding = await loop.run_in_executor(
-                None,
-                self.embedding_model.encode,
-                text
+            torch.set_num_interop_threads(TORCH_INTEROP_THREADS)
+        except RuntimeError:
+            # Can only be set before any inter-op work has started, e.g. not on a reload
+            pass
+        torch.backends.mkldnn.enabled = True
+
+    def _encode(self, texts: List[str], batch_size: int) -> np.ndarray:
+        """Encode normalized embeddings without autograd, under BF16 autocast where the CPU supports it"""
+        with torch.inference_mode(), torch.autocast("cpu", dtype=torch.bfloat16, enabled=self.autocast_bf16):
+            return self.embedding_model.encode(
+                texts,
+                batch_size=batch_size,
+                convert_to_numpy=True,
+                normalize_embeddings=True,
+                show_progress_bar=False
             )
-            return embedding.tolist()
+
+    def _load_quantized_onnx_model(self) -> SentenceTransformer:
+        """Load the INT8 ONNX export of the embedding model, exporting it on first use"""
+        model_dir = os.path.join(ONNX_CACHE_DIR, self.embedding_model_name.replace("/", "__"))
+        file_name = f"onnx/model_qint8_{ONNX_QUANTIZATION}.onnx"
+
+        if not os.path.exists(os.path.join(model_dir, file_name)):
+            print(f"Exporting INT8 ONNX embedding model to {model_dir}...")
+            model = SentenceTransformer(self.embedding_model_name, backend="onnx", device=self.device)
+            model.save(model_dir)
+            export_dynamic_quantized_onnx_model(model, ONNX_QUANTIZATION, model_dir)
+
+        # Imported here so the PyTorch fallback still works without the ONNX extra installed
+        import onnxruntime
+
+        # ONNX Runtime otherwise sizes its own intra-op pool to every core, ignoring the torch settings
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = TORCH_NUM_THREADS
+        session_options.inter_op_num_threads = TORCH_INTEROP_THREADS
+
+        return SentenceTransformer(
+            model_dir,
+            backend="onnx",
+            device=self.device,
+            model_kwargs={"file_name": file_name, "session_options": session_options}
+        )
+
+    async def shutdown(self):
+        """Stop the embedding micro-batcher"""
+        if self._batch_task:
+            self._batch_task.cancel()
+
+    async def _batch_loop(self):
+        """Coalesce concurrent get_embedding calls into batched encode calls"""
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._embedding_queue.get()]
+            deadline = loop.time() + EMBEDDING_MAX_WAIT
+            while len(batch) < EMBEDDING_MAX_BATCH:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._embedding_queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                # Run embedding generation in thread pool to avoid blocking
+                embeddings = await asyncio.to_thread(
+                    self._encode, [text for text, _ in batch], EMBEDDING_MAX_BATCH
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding.tolist())
+
+    async def get_embedding(self, text: str) -> List[float]:
+        """Generate embedding for text using SentenceTransformer, batched with concurrent callers"""
+        # The embedding model is uncased, so case and surrounding whitespace never change the vector
+        key = hashlib.blake2b(text.strip().lower().encode()).digest()
+        embedding = self._query_embedding_cache.get(key)
+        if embedding is not None:
+            self._query_embedding_cache.move_to_end(key)
+            return embedding
+
+        try:
+            future = asyncio.get_running_loop().create_future()
+            await self._embedding_queue.put((text, future))
+            embedding = await future
         except Exception as e:
             print(f"Error generating embedding: {str(e)}")
             raise
 
-    async def get_relevant_chunks(self, query: str, chat_id: str, db: Session, top_k: int = 5) -> List[Dict[str, Any]]:
-        """Retrieve relevant document chunks using vector similarity for a specific chat"""
-        try:
-            # Get query embedding
-            query_embedding = await self.get_embedding(query)
+        self._query_embedding_cache[key] = embedding
+        if len(self._query_embedding_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+            self._query_embedding_cache.popitem(last=False)
+        return embedding
 
-            # Use pgvector for similarity search within the specific chat
-            similarity_query = text("""
-                SELECT 
-                    dc.chunk_text,
-                    dc.chunk_index,
-                    d.filename,
-                    dc.embedding <-> :query_embedding as distance
-                FROM document_chunks dc
-                JOIN documents d ON dc.document_id = d.id
-                WHERE dc.chat_id = :chat_id
-                ORDER BY dc.embedding <-> :query_embedding
-                LIMIT :limit
-            """)
-
-            result = db.execute(
-                similarity_query,
-                {
-                    "query_embedding": str(query_embedding),
-                    "chat_id": chat_id,
-                    "limit": top_k
-                }
-            )
+    def _embedding_cache_key(self, text: str) -> str:
+        """Hash a chunk together with the model name so switching models never reuses stale vectors"""
+        return xxhash.xxh64(f"{self.embedding_model_name}\0{text}".encode()).hexdigest()
 
-            relevant_chunks = []
-            for row in result:
-                relevant_chunks.append({
-                    "text": row.chunk_text,
-                    "chunk_index": row.chunk_index,
-                    "filename": row.filename,
-                    "similarity_score": 1 - row.distance  # Convert distance to similarity
-                })
+    def _encode_cached(self, texts: List[str]) -> List[List[float]]:
+        """Encode texts, reusing cached embeddings and running the model only on misses"""
+        keys = [self._embedding_cache_key(text) for text in texts]
+        embeddings = [self.embedding_cache.get(key) for key in keys]
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
 
-            return relevant_chunks
+        if misses:
+            encoded = self._encode([texts[i] for i in misses], self.embedding_batch_size).tolist()
+            for i, embedding in zip(misses, encoded):
+                embeddings[i] = embedding
+                self.embedding_cache.set(keys[i], embedding)
 
-        except Exception as e:
-            print(f"Error retrieving relevant chunks: {str(e)}")
-            # Fallback: return some chunks without similarity scoring from the specific chat
-            chunks = db.query(DocumentChunk).filter(
-                DocumentChunk.chat_id == uuid.UUID(chat_id)
-            ).limit(top_k).all()
-
-            return [
-                {
-                    "text": chunk.chunk_text,
-                    "chunk_index": chunk.chunk_index,
-                    "filename": "unknown",
-                    "similarity_score": 0.5
-                }
-                for chunk in chunks
-            ]
+        return embeddings
+
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """Generate embeddings for many texts with a single batched encode call"""
+        if not texts:
+            return []
 
-    async def generate_response(self, query: str, relevant_chunks: List[Dict[str, Any]]) -> str:
-        """Generate response using Ollama Llama3 model"""
         try:
-            # Prepare context from relevant chunks
-            context = ""
-            for i, chunk in enumerate(relevant_chunks):
-                context += f"Document {i + 1} ({chunk['filename']}):\n{chunk['text']}\n\n"
+            return await asyncio.to_thread(self._encode_cached, texts)
+        except Exception as e:
+            print(f"Error generating embeddings: {str(e)}")
+            raise
 
-            # Create prompt
-            prompt = f"""Based on the following context, please answer the question. If the answer cannot be found in the context, please say so.
+    def _search_chunks(
+            self, query_embedding: List[float], chat_id: uuid.UUID, db: Session, top_k: int
+    ) -> List[Dict[str, Any]]:
+        """Run the pgvector similarity query for a specific chat"""
+        # Tune HNSW search for this transaction in the same thread hop as the query, once the embedding is ready
+        apply_hnsw_search_params(db, top_k)
+        result = db.execute(
+            SIMILARITY_QUERY,
+            {
+                "query_embedding": str(query_embedding),
+                "chat_id": str(chat_id),
+                "candidates": top_k * BINARY_RERANK_FACTOR,
+                "limit": top_k
+            }
+        )
 
-Context:
-{context}
+        return result.scalar_one() or []
 
-Question: {query}
+    def _fallback_chunks(self, chat_id: uuid.UUID, db: Session, top_k: int) -> List[Dict[str, Any]]:
+        """Return some chunks without similarity scoring from the specific chat"""
+        # A failed similarity query leaves the transaction aborted
+        db.rollback()
+        rows = db.execute(FALLBACK_QUERY, {"chat_id": str(chat_id), "limit": top_k}).mappings()
+
+        return [
+            {
+                "text": row["chunk_text"],
+                "chunk_index": row["chunk_index"],
+                "filename": row["filename"],
+                "similarity_score": 0.5
+            }
+            for row in rows
+        ]
+
+    async def get_relevant_chunks(
+            self, query: str, chat_id: uuid.UUID, db: Session, top_k: int = 5
+    ) -> List[Dict[str, Any]]:
+        """Retrieve relevant document chunks using vector similarity for a specific chat"""
+        # Database work runs in the thread pool so it does not block the event loop
+        try:
+            # Get query embedding
+            query_embedding = await self.get_embedding(query)
+            return await asyncio.to_thread(self._search_chunks, query_embedding, chat_id, db, top_k)
+
+        except Exception as e:
+            print(f"Error retrieving relevant chunks: {str(e)}")
+            return await asyncio.to_thread(self._fallback_chunks, chat_id, db, top_k)
 
-Answer:"""
+    def _build_messages(self, query: str, relevant_chunks: List[Dict[str, Any]]) -> List[Dict[str, str]]:
+        """Build the chat messages: the static instructions first, then the query and its retrieved chunks"""
+        # Prepare context from relevant chunks
+        context = "\n\n".join(
+            f"Document {i + 1} ({chunk['filename']}):\n{chunk['text']}"
+            for i, chunk in enumerate(relevant_chunks)
+        )
 
+        return [
+            {
+                'role': 'system',
+                'content': STATIC_INSTRUCTIONS
+            },
+            {
+                'role': 'user',
+                'content': ANSWER_PROMPT.substitute(context=context, query=query)
+            }
+        ]
+
+    async def generate_response(self, query: str, relevant_chunks: List[Dict[str, Any]]) -> str:
+        """Generate response using Ollama Llama3 model"""
+        try:
             # Generate response using Ollama
-            response = self.client.chat(
+            response = await self.client.chat(
                 model=self.model_name,
-                messages=[
-                    {
-                        'role': 'user',
-                        'content': prompt
-                    }
-                ],
-                options={
-                    'temperature': 0.7,
-                    'top_p': 0.9,
-                    'max_tokens': 1000
-                }
+                messages=self._build_messages(query, relevant_chunks),
+                options=RESPONSE_OPTIONS,
+                keep_alive=OLLAMA_KEEP_ALIVE
             )
 
             return response['message']['content']
@@ -327,6 +562,23 @@ Answer:"""
             print(f"Error generating response: {str(e)}")
             return f"I apologize, but I encountered an error while generating a response: {str(e)}"
 
+    async def stream_response(self, query: str, relevant_chunks: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """Generate response using Ollama Llama3 model, yielding tokens as they arrive"""
+        try:
+            stream = await self.client.chat(
+                model=self.model_name,
+                messages=self._build_messages(query, relevant_chunks),
+                options=RESPONSE_OPTIONS,
+                keep_alive=OLLAMA_KEEP_ALIVE,
+                stream=True
+            )
+            async for chunk in stream:
+                yield chunk['message']['content']
+
+        except Exception as e:
+            print(f"Error streaming response: {str(e)}")
+            yield f"I apologize, but I encountered an error while generating a response: {str(e)}"
+
     async def generate_chat_title(self, first_message: str) -> str:
         """Generate a title for the chat based on the first message"""
         try:
@@ -334,7 +586,7 @@ Answer:"""
 
 Title:"""
 
-            response = self.client.chat(
+            response = await self.client.chat(
                 model=self.model_name,
                 messages=[
                     {
@@ -345,7 +597,8 @@ Title:"""
                 options={
                     'temperature': 0.5,
                     'max_tokens': 50
-                }
+                },
+                keep_alive=OLLAMA_KEEP_ALIVE
             )
 
             title = response['message']['content'].strip()
@@ -0,0 +1,71 @@
+import struct
+import unittest
+import uuid
+
+from pgcopy import CHUNK_COPY_COLUMNS, PGCOPY_HEADER, encode_chunk_rows, encode_halfvec
+
+
+def decode_chunk_rows(data: bytes):
+    """Decode a binary COPY stream back into lists of raw field bytes, checking its framing"""
+    assert data.startswith(PGCOPY_HEADER)
+    offset = len(PGCOPY_HEADER)
+    rows = []
+    while True:
+        (field_count,) = struct.unpack_from(">h", data, offset)
+        offset += 2
+        if field_count == -1:
+            break
+        fields = []
+        for _ in range(field_count):
+            (length,) = struct.unpack_from(">i", data, offset)
+            offset += 4
+            fields.append(data[offset:offset + length])
+            offset += length
+        rows.append(fields)
+    assert offset == len(data), "trailing bytes after the COPY trailer"
+    return rows
+
+
+class EncodeChunkRowsTest(unittest.TestCase):
+    def setUp(self):
+        self.row = {
+            "id": uuid.uuid4(),
+            "chat_id": uuid.uuid4(),
+            "document_id": uuid.uuid4(),
+            "chunk_text": "Grüße aus dem Dokument",
+            "chunk_index": 7,
+            "embedding": [0.5, -0.25, 1.0],
+        }
+
+    def test_round_trip(self):
+        rows = decode_chunk_rows(encode_chunk_rows([self.row, self.row]))
+
+        self.assertEqual(len(rows), 2)
+        fields = rows[0]
+        self.assertEqual(len(fields), len(CHUNK_COPY_COLUMNS))
+        self.assertEqual(uuid.UUID(bytes=fields[0]), self.row["id"])
+        self.assertEqual(uuid.UUID(bytes=fields[1]), self.row["chat_id"])
+        self.assertEqual(uuid.UUID(bytes=fields[2]), self.row["document_id"])
+        self.assertEqual(fields[3].decode(), self.row["chunk_text"])
+        self.assertEqual(struct.unpack(">i", fields[4])[0], 7)
+        self.assertEqual(fields[5], encode_halfvec(self.row["embedding"]))
+
+    def test_generates_missing_ids(self):
+        del self.row["id"]
+        first, second = decode_chunk_rows(encode_chunk_rows([self.row, self.row]))
+
+        self.assertNotEqual(first[0], second[0])
+
+    def test_empty_stream(self):
+        self.assertEqual(decode_chunk_rows(encode_chunk_rows([])), [])
+
+    def test_halfvec_layout(self):
+        encoded = encode_halfvec([0.5, -0.25, 1.0])
+
+        self.assertEqual(struct.unpack_from(">HH", encoded), (3, 0))
+        self.assertEqual(struct.unpack_from(">3e", encoded, 4), (0.5, -0.25, 1.0))
+        self.assertEqual(len(encoded), 4 + 3 * 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,11 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import List, Dict, Any
 import uuid
@@ -8,6 +13,17 @@ import uuid
 # Configuration
 API_BASE_URL = "http://localhost:8003"
 
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Pooled keep-alive HTTP session to the backend, shared across Streamlit reruns"""
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=3))
+    return session
+
+
+SESSION = get_http_session()
+
 # Initialize session state
 if "current_chat_id" not in st.session_state:
     st.session_state.current_chat_id = None
@@ -19,14 +35,35 @@ if "chat_documents" not in st.session_state:
     st.session_state.chat_documents = []
 
 
+@st.cache_data(ttl=15, show_spinner=False)
+def fetch_chats() -> List[Dict[str, Any]]:
+    """Fetch all chats from the backend, cached briefly across reruns"""
+    response = SESSION.get(f"{API_BASE_URL}/chats")
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_chat_messages(chat_id: str) -> List[Dict[str, Any]]:
+    """Fetch the messages of a chat from the backend"""
+    response = SESSION.get(f"{API_BASE_URL}/chats/{chat_id}/messages")
+    response.raise_for_status()
+    return response.json()
+
+
+@st.cache_data(ttl=15, show_spinner=False)
+def fetch_chat_documents(chat_id: str) -> List[Dict[str, Any]]:
+    """Fetch the documents of a chat from the backend, cached briefly across reruns"""
+    response = SESSION.get(f"{API_BASE_URL}/chats/{chat_id}/documents")
+    response.raise_for_status()
+    return response.json()
+
+
 def load_chats():
     """Load all chats from the backend"""
     try:
-        response = requests.get(f"{API_BASE_URL}/chats")
-        if response.status_code == 200:
-            st.session_state.chats = response.json()
-        else:
-            st.error("Failed to load chats")
+        st.session_state.chats = fetch_chats()
+    except requests.exceptions.HTTPError:
+        st.error("Failed to load chats")
     except requests.exceptions.RequestException as e:
         st.error(f"Error connecting to backend: {str(e)}")
 
@@ -37,7 +74,7 @@ def create_new_chat(title: str = None):
         title = f"New Chat {datetime.now().strftime('%H:%M')}"
 
     try:
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE_URL}/chats",
             json={"title": title}
         )
@@ -46,6 +83,7 @@ def create_new_chat(title: str = None):
             st.session_state.current_chat_id = new_chat["id"]
             st.session_state.messages = []
             st.session_state.chat_documents = []
+            fetch_chats.clear()
             load_chats()
             st.rerun()
         else:
@@ -57,11 +95,9 @@ def create_new_chat(title: str = None):
 def load_chat_messages(chat_id: str):
     """Load messages for a specific chat"""
     try:
-        response = requests.get(f"{API_BASE_URL}/chats/{chat_id}/messages")
-        if response.status_code == 200:
-            st.session_state.messages = response.json()
-        else:
-            st.error("Failed to load chat messages")
+        st.session_state.messages = fetch_chat_messages(chat_id)
+    except requests.exceptions.HTTPError:
+        st.error("Failed to load chat messages")
     except requests.exceptions.RequestException as e:
         st.error(f"Error loading messages: {str(e)}")
 
@@ -69,48 +105,67 @@ def load_chat_messages(chat_id: str):
 def load_chat_documents(chat_id: str):
     """Load documents for a specific chat"""
     try:
-        response = requests.get(f"{API_BASE_URL}/chats/{chat_id}/documents")
-        if response.status_code == 200:
-            st.session_state.chat_documents = response.json()
-        else:
-            st.error("Failed to load chat documents")
+        st.session_state.chat_documents = fetch_chat_documents(chat_id)
+    except requests.exceptions.HTTPError:
+        st.error("Failed to load chat documents")
     except requests.exceptions.RequestException as e:
         st.error(f"Error loading documents: {str(e)}")
 
 
-def send_query(query: str, chat_id: str):
-    """Send a query to the RAG system"""
+def load_chat_data(chat_id: str):
+    """Load messages and documents for a specific chat with both requests in flight at once"""
+    # Worker threads get this run's context so cached fetches behave as on the script thread
+    with ThreadPoolExecutor(
+            max_workers=2, initializer=add_script_run_ctx, initargs=(None, get_script_run_ctx())
+    ) as executor:
+        messages = executor.submit(fetch_chat_messages, chat_id)
+        documents = executor.submit(fetch_chat_documents, chat_id)
+
     try:
-        payload = {"query": query, "chat_id": chat_id}
+        st.session_state.messages = messages.result()
+    except requests.exceptions.HTTPError:
+        st.error("Failed to load chat messages")
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error loading messages: {str(e)}")
 
-        response = requests.post(
-            f"{API_BASE_URL}/query",
-            json=payload
-        )
+    try:
+        st.session_state.chat_documents = documents.result()
+    except requests.exceptions.HTTPError:
+        st.error("Failed to load chat documents")
+    except requests.exceptions.RequestException as e:
+        st.error(f"Error loading documents: {str(e)}")
 
-        if response.status_code == 200:
-            return response.json()
-        else:
-            st.error(f"Query failed: {response.text}")
-            return None
+
+def stream_query(query: str, chat_id: str):
+    """Send a query to the RAG system and yield the response text as it is generated"""
+    try:
+        payload = {"query": query, "chat_id": chat_id}
+
+        with SESSION.post(f"{API_BASE_URL}/query/stream", json=payload, stream=True) as response:
+            if response.status_code != 200:
+                st.error(f"Query failed: {response.text}")
+                return
+            response.encoding = "utf-8"
+            yield from response.iter_content(chunk_size=None, decode_unicode=True)
     except requests.exceptions.RequestException as e:
         st.error(f"Error sending query: {str(e)}")
-        return None
 
 
 def upload_documents(files, chat_id: str):
     """Upload documents to the backend for a specific chat"""
     try:
-        files_data = []
+        # Stream each file into the request body instead of copying every file's bytes first
         for file in files:
-            files_data.append(("files", (file.name, file.getvalue(), file.type)))
+            file.seek(0)
+        encoder = MultipartEncoder(fields=[("files", (file.name, file, file.type)) for file in files])
 
-        response = requests.post(
+        response = SESSION.post(
             f"{API_BASE_URL}/upload-documents/{chat_id}",
-            files=files_data
+            data=encoder,
+            headers={"Content-Type": encoder.content_type}
         )
 
-        if response.status_code == 200:
+        if response.status_code in (200, 202):
             return response.json()
         else:
             st.error(f"Upload failed: {response.text}")
@@ -120,15 +175,43 @@ def upload_documents(files, chat_id: str):
         return None
 
 
+def wait_for_uploads(jobs: List[Dict[str, Any]], timeout: float = 600, interval: float = 1.0) -> List[Dict[str, Any]]:
+    """Poll background upload jobs until they finish or the timeout expires"""
+    pending = {job["job_id"] for job in jobs}
+    finished = []
+    deadline = time.time() + timeout
+
+    while pending and time.time() < deadline:
+        for job_id in list(pending):
+            try:
+                response = SESSION.get(f"{API_BASE_URL}/uploads/{job_id}")
+            except requests.exceptions.RequestException as e:
+                st.error(f"Error checking upload status: {str(e)}")
+                return finished
+
+            if response.status_code != 200:
+                pending.discard(job_id)
+            elif response.json()["status"] != "processing":
+                finished.append(response.json())
+                pending.discard(job_id)
+
+        if pending:
+            time.sleep(interval)
+
+    return finished
+
+
 def delete_chat(chat_id: str):
     """Delete a chat"""
     try:
-        response = requests.delete(f"{API_BASE_URL}/chats/{chat_id}")
+        response = SESSION.delete(f"{API_BASE_URL}/chats/{chat_id}")
         if response.status_code == 200:
             if st.session_state.current_chat_id == chat_id:
                 st.session_state.current_chat_id = None
                 st.session_state.messages = []
                 st.session_state.chat_documents = []
+            fetch_chats.clear()
+            fetch_chat_documents.clear()
             load_chats()
             st.rerun()
         else:
@@ -140,10 +223,11 @@ def delete_chat(chat_id: str):
 def delete_document(document_id: str):
     """Delete a document"""
     try:
-        response = requests.delete(f"{API_BASE_URL}/documents/{document_id}")
+        response = SESSION.delete(f"{API_BASE_URL}/documents/{document_id}")
         if response.status_code == 200:
             # Reload documents for current chat
             if st.session_state.current_chat_id:
+                fetch_chat_documents.clear()
                 load_chat_documents(st.session_state.current_chat_id)
             st.rerun()
         else:
@@ -171,9 +255,8 @@ with st.sidebar:
 
     st.divider()
 
-    # Load chats on first run
-    if not st.session_state.chats:
-        load_chats()
+    # Load chats; served from cache unless it expired or a chat was created or deleted
+    load_chats()
 
     # Display existing chats
     if st.session_state.chats:
@@ -190,8 +273,7 @@ with st.sidebar:
                         type=button_type
                 ):
                     st.session_state.current_chat_id = chat['id']
-                    load_chat_messages(chat['id'])
-                    load_chat_documents(chat['id'])
+                    load_chat_data(chat['id'])
                     st.rerun()
 
             with col2:
@@ -250,14 +332,18 @@ if st.session_state.current_chat_id:
                         submit_button = st.form_submit_button("Send", type="primary")
 
                     if submit_button and query.strip():
-                        with st.spinner("Generating response..."):
-                            # Send query
-                            result = send_query(query, st.session_state.current_chat_id)
-
-                            if result:
-                                # Reload messages from backend to sync
-                                load_chat_messages(st.session_state.current_chat_id)
-                                st.rerun()
+                        with st.chat_message("user"):
+                            st.write(query)
+
+                        # Render the answer token by token as the backend streams it
+                        with st.chat_message("assistant"):
+                            response = st.write_stream(stream_query(query, st.session_state.current_chat_id))
+
+                        if response:
+                            # Reload messages from backend to sync; the chat moved to the top of the list
+                            fetch_chats.clear()
+                            load_chat_messages(st.session_state.current_chat_id)
+                            st.rerun()
             else:
                 st.warning("📁 Please upload documents first before asking questions!")
                 if st.button("Go to Documents Tab", type="secondary"):
@@ -282,11 +368,22 @@ if st.session_state.current_chat_id:
                     with st.spinner("Uploading and processing documents..."):
                         result = upload_documents(uploaded_files, st.session_state.current_chat_id)
                         if result:
-                            uploaded_count = len(result.get('uploaded', []))
+                            queued = result.get('queued', [])
                             skipped_count = len(result.get('skipped', []))
 
-                            if uploaded_count > 0:
-                                st.success(f"✅ Successfully uploaded {uploaded_count} documents!")
+                            # Documents are processed in the background; wait for them to finish
+                            finished = wait_for_uploads(queued) if queued else []
+                            completed = [job for job in finished if job['status'] == 'completed']
+                            failed = [job for job in finished if job['status'] == 'failed']
+
+                            if completed:
+                                st.success(f"✅ Successfully uploaded {len(completed)} documents!")
+
+                            for job in failed:
+                                st.error(f"❌ {job['filename']}: {job['error']}")
+
+                            if len(finished) < len(queued):
+                                st.info("⏳ Some documents are still processing. Refresh the chat data to see them.")
 
                             if skipped_count > 0:
                                 st.warning(f"⚠️ Skipped {skipped_count} documents:")
@@ -294,6 +391,7 @@ if st.session_state.current_chat_id:
                                     st.write(f"• {skipped['filename']}: {skipped['reason']}")
 
                             # Reload documents
+                            fetch_chat_documents.clear()
                             load_chat_documents(st.session_state.current_chat_id)
                             st.rerun()
 
@@ -336,8 +434,8 @@ if st.session_state.current_chat_id:
             with col2:
                 st.write("**Actions**")
                 if st.button("🔄 Refresh Chat Data", type="secondary"):
-                    load_chat_messages(st.session_state.current_chat_id)
-                    load_chat_documents(st.session_state.current_chat_id)
+                    fetch_chat_documents.clear()
+                    load_chat_data(st.session_state.current_chat_id)
                     st.success("Chat data refreshed!")
                     st.rerun()
 
@@ -382,7 +480,7 @@ else:
         st.subheader("🔧 System Status")
         if st.button("Check API Connection"):
             try:
-                response = requests.get(f"{API_BASE_URL}/")
+                response = SESSION.get(f"{API_BASE_URL}/")
                 if response.status_code == 200:
                     st.success("✅ Backend API is running")
                 else: